@@ -11,7 +11,8 @@ echo "Starting Compute Engine ngram processing setup..."
 apt-get update
 
 # Install Python, pip, curl, jq (for metadata and token handling)
-apt-get install -y python3 python3-pip curl jq
+# and a C toolchain so pyximport can compile the shard parser
+apt-get install -y python3 python3-pip python3-dev build-essential curl jq
 
 # Working directory
 mkdir -p /opt/ngram-processor
@@ -29,6 +30,7 @@ FIREBASE_STORAGE_BUCKET=${FIREBASE_STORAGE_BUCKET#gs://}
 SCRIPTS_BUCKET=$(md instance/attributes/startup-scripts-bucket)
 SCRIPTS_PREFIX=$(md instance/attributes/startup-scripts-prefix)
 FIRESTORE_DB=$(md instance/attributes/firestore-database)
+NGRAM_CACHE_DIR=$(md instance/attributes/ngram-cache-dir)
 
 # Fallbacks
 SCRIPTS_BUCKET=${SCRIPTS_BUCKET:-$FIREBASE_STORAGE_BUCKET}
@@ -39,6 +41,10 @@ echo "Using scripts bucket: ${SCRIPTS_BUCKET} (prefix: ${SCRIPTS_PREFIX})"
 # Export settings for Python script
 export FIREBASE_STORAGE_BUCKET=${FIREBASE_STORAGE_BUCKET}
 export FIRESTORE_DB=${FIRESTORE_DB}
+if [ -n "${NGRAM_CACHE_DIR}" ]; then
+  mkdir -p "${NGRAM_CACHE_DIR}"
+  export NGRAM_CACHE_DIR
+fi
 
 # Obtain an access token for authenticated GCS downloads
 ACCESS_TOKEN=$(md instance/service-accounts/default/token | jq -r .access_token)
@@ -58,6 +64,9 @@ gcs_download "${SCRIPTS_BUCKET}" "${SCRIPTS_PREFIX}/requirements.txt" \
   /opt/ngram-processor/requirements.txt || true
 gcs_download "${SCRIPTS_BUCKET}" "${SCRIPTS_PREFIX}/ngram_processor.py" \
   /opt/ngram-processor/ngram_processor.py
+# Optional compiled parser; the processor falls back to pure Python without it
+gcs_download "${SCRIPTS_BUCKET}" "${SCRIPTS_PREFIX}/ngram_parse.pyx" \
+  /opt/ngram-processor/ngram_parse.pyx || true
 
 # Install Python dependencies if present
 if [ -f /opt/ngram-processor/requirements.txt ]; then
@@ -67,6 +76,11 @@ else
   pip3 install google-cloud-storage google-cloud-firestore requests
 fi
 
+# rapidgzip only decodes seekable sources, i.e. shards read back from the local cache
+if [ -n "${NGRAM_CACHE_DIR}" ]; then
+  pip3 install rapidgzip || true
+fi
+
 chmod +x /opt/ngram-processor/ngram_processor.py
 
 # Run the processor
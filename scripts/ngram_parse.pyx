@@ -0,0 +1,156 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, initializedcheck=False
+"""
+Compiled shard parser for ngram_processor.py
+Built on first import through pyximport; same results as parse_block_py
+"""
+
+from libc.stdint cimport uint8_t, uint64_t
+from libc.string cimport memchr, memcmp, memcpy
+
+# Byte classes for gram validation
+cdef enum:
+    OTHER = 0
+    LETTER = 1
+    SPACE = 2
+
+cdef uint8_t CHAR_CLASS[256]
+for _c in range(256):
+    CHAR_CLASS[_c] = OTHER
+for _c in range(26):
+    CHAR_CLASS[ord('a') + _c] = LETTER
+    CHAR_CLASS[ord('A') + _c] = LETTER
+CHAR_CLASS[ord(' ')] = SPACE
+
+cdef uint64_t HIGH_BITS = 0x8080808080808080ULL
+
+
+cdef inline bint all_alpha8(const unsigned char* s) noexcept nogil:
+    """Branchless check that 8 bytes are all ASCII letters"""
+    cdef uint64_t w
+    memcpy(&w, s, 8)
+    if w & HIGH_BITS:
+        return False
+    # Fold upper case onto lower case; a lane's high bit then flips on at 'a' (+0x1f)
+    # and at '{' (+0x05), and no lane can carry into its neighbour
+    w |= 0x2020202020202020ULL
+    return ((w + 0x1f1f1f1f1f1f1f1fULL) & ~(w + 0x0505050505050505ULL) & HIGH_BITS) == HIGH_BITS
+
+
+cdef inline int count_tokens(const unsigned char* s, Py_ssize_t length, const int max_tokens) noexcept nogil:
+    """Number of space separated tokens, or -1 unless every token is non-empty and alphabetic"""
+    cdef Py_ssize_t i = 0, stop, tok_len = 0
+    cdef int tokens = 1
+    cdef uint8_t cls
+    while i < length:
+        if i + 8 <= length and all_alpha8(s + i):
+            tok_len += 8
+            i += 8
+            continue
+        # The next 8 bytes hold a separator or an invalid byte; classify them one by one
+        stop = i + 8 if i + 8 < length else length
+        while i < stop:
+            cls = CHAR_CLASS[s[i]]
+            if cls == LETTER:
+                tok_len += 1
+            elif cls == SPACE and tok_len and tokens < max_tokens:
+                tokens += 1
+                tok_len = 0
+            else:
+                return -1
+            i += 1
+    return tokens if tok_len else -1
+
+
+cdef inline void add_run(dict agg, const unsigned char* data, Py_ssize_t start,
+                         Py_ssize_t length, long long total):
+    key = data[start:start + length]
+    agg[key] = agg.get(key, 0) + total
+
+
+cdef inline Py_ssize_t parse_lines(const unsigned char* data, Py_ssize_t end, const int n,
+                                   dict agg) except -1:
+    """Add the grams of a block of complete lines into agg; returns the number of lines"""
+    cdef const unsigned char* nl
+    cdef const unsigned char* tab
+    cdef Py_ssize_t pos = 0, line_end, p, gram_len
+    cdef Py_ssize_t run_start = -1, run_len = 0
+    cdef long long run_total = 0, count
+    cdef int digits
+    cdef Py_ssize_t lines = 0
+
+    while pos < end:
+        nl = <const unsigned char*> memchr(data + pos, c'\n', end - pos)
+        line_end = (nl - data) if nl != NULL else end
+        lines += 1
+
+        # ngram<TAB>year<TAB>match_count<TAB>volume_count; every token must be
+        # non-empty and purely alphabetic
+        tab = <const unsigned char*> memchr(data + pos, c'\t', line_end - pos)
+        if tab == NULL:
+            pos = line_end + 1
+            continue
+        gram_len = tab - (data + pos)
+        if count_tokens(data + pos, gram_len, n) != n:
+            pos = line_end + 1
+            continue
+
+        # Skip the year field
+        p = pos + gram_len + 1
+        tab = <const unsigned char*> memchr(data + p, c'\t', line_end - p)
+        if tab == NULL:
+            pos = line_end + 1
+            continue
+        p = tab - data
+
+        # Parse match_count
+        p += 1
+        count = 0
+        digits = 0
+        while p < line_end and c'0' <= data[p] <= c'9':
+            count = count * 10 + (data[p] - c'0')
+            digits += 1
+            p += 1
+        if digits == 0 or (p < line_end and data[p] != c'\t' and data[p] != c'\r'):
+            pos = line_end + 1
+            continue
+
+        # Consecutive rows of the same gram collapse into a single dict update
+        if run_start >= 0 and gram_len == run_len and memcmp(data + pos, data + run_start, gram_len) == 0:
+            run_total += count
+        else:
+            if run_start >= 0:
+                add_run(agg, data, run_start, run_len, run_total)
+            run_start = pos
+            run_len = gram_len
+            run_total = count
+
+        pos = line_end + 1
+
+    if run_start >= 0:
+        add_run(agg, data, run_start, run_len, run_total)
+    return lines
+
+
+# One entry point per n; each inlines parse_lines with n as a constant, so the
+# C compiler specializes the token loop for that gram size
+def parse_1gram(const unsigned char[::1] buf, dict agg):
+    return parse_lines(&buf[0], buf.shape[0], 1, agg) if buf.shape[0] else 0
+
+
+def parse_2gram(const unsigned char[::1] buf, dict agg):
+    return parse_lines(&buf[0], buf.shape[0], 2, agg) if buf.shape[0] else 0
+
+
+def parse_3gram(const unsigned char[::1] buf, dict agg):
+    return parse_lines(&buf[0], buf.shape[0], 3, agg) if buf.shape[0] else 0
+
+
+def parse_4gram(const unsigned char[::1] buf, dict agg):
+    return parse_lines(&buf[0], buf.shape[0], 4, agg) if buf.shape[0] else 0
+
+
+def parse_5gram(const unsigned char[::1] buf, dict agg):
+    return parse_lines(&buf[0], buf.shape[0], 5, agg) if buf.shape[0] else 0
+
+
+PARSERS = {1: parse_1gram, 2: parse_2gram, 3: parse_3gram, 4: parse_4gram, 5: parse_5gram}
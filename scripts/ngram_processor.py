@@ -5,17 +5,49 @@ Processes Google Ngram data and uploads results to Firebase Storage
 """
 
 import os
+import io
+import glob
+import hashlib
 import json
 import gzip
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 import time
-from typing import Dict, List, Tuple, Optional
-from collections import defaultdict
-import re
+import queue
+import threading
+from typing import Callable, Dict, Iterator, List, Set, Tuple, Optional
+from heapq import nlargest
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+import string
 from google.cloud import storage, firestore
+from google.cloud.storage.retry import DEFAULT_RETRY
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.bulk_writer import BulkWriteFailure, BulkWriter
 from google.auth import default
 import logging
 
+try:
+    # ISA-L backed gzip decoding is roughly twice as fast as stdlib zlib
+    from isal import igzip as gzip_impl
+except ImportError:
+    gzip_impl = gzip
+
+try:
+    # rapidgzip decodes deflate blocks of a single (seekable) shard on several threads
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+try:
+    # orjson encodes large lists/dicts several times faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -29,14 +61,204 @@ TOP_COUNTS = {
     '4gram': 10000,
     '5gram': 10000
 }
+# Shards are I/O-bound downloads, so a thread pool fans them out in parallel
+SHARD_WORKERS = int(os.environ.get('NGRAM_SHARD_WORKERS', '32'))
+SHARD_RETRIES = 3
+# Uploads run in the background so finished shards never stall the parse loop
+UPLOAD_WORKERS = 8
+# Attempts per checkpoint write before the BulkWriter gives up; matches its default retry budget
+CHECKPOINT_WRITE_ATTEMPTS = 15
+# Errors raised while streaming a shard body, including truncated gzip data
+RETRYABLE_ERRORS = (requests.RequestException, urllib3.exceptions.HTTPError, EOFError)
+GZIP_BUFFER_SIZE = 128 * 1024
+# Threads per shard for rapidgzip; kept small since shards already run in parallel
+GZIP_PARALLELIZATION = min(4, os.cpu_count() or 1)
+# Decompressed bytes parsed per block; lines are split out of each block in one call
+READ_BLOCK_SIZE = 1 << 20
+# Compressed bytes per network read, and blocks buffered between pipeline stages
+RAW_CHUNK_SIZE = 1 << 20
+PIPELINE_DEPTH = 4
+# Optional local directory (e.g. an attached SSD) for raw shard downloads, so reruns
+# skip the network for shards whose ETag has not changed
+SHARD_CACHE_DIR = os.environ.get('NGRAM_CACHE_DIR')
+LOG_EVERY_LINES = 50000
+UPLOAD_GZIP_LEVEL = 6
 
-def is_alpha(word: str) -> bool:
-    """Check if word contains only alphabetic characters"""
-    return bool(re.match(r'^[a-zA-Z]+$', word))
+# One pooled session keeps connections to storage.googleapis.com alive across shards.
+# Shards are already gzip files, so ask for them as-is rather than re-encoded.
+SESSION = requests.Session()
+SESSION.headers['Accept-Encoding'] = 'identity'
+_adapter = HTTPAdapter(pool_connections=SHARD_WORKERS, pool_maxsize=SHARD_WORKERS,
+                       max_retries=Retry(total=5, backoff_factor=1, status_forcelist=(500, 502, 503, 504)))
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
 
-def is_clean_gram(tokens: List[str]) -> bool:
-    """Check if all tokens in gram are alphabetic"""
-    return len(tokens) > 0 and all(is_alpha(token) for token in tokens)
+# Deletes ASCII letters and the separator, so an alphabetic gram translates to empty bytes
+_GRAM_DELETE_BYTES = (string.ascii_letters + ' ').encode('ascii')
+
+def open_gzip_stream(fileobj) -> io.BufferedReader:
+    """Wrap a binary gzip file object in the fastest available decompressing reader"""
+    # rapidgzip seeks between deflate blocks, so it only applies to seekable sources
+    if rapidgzip is not None and fileobj.seekable():
+        stream = rapidgzip.RapidgzipFile(fileobj, parallelization=GZIP_PARALLELIZATION)
+    else:
+        stream = gzip_impl.GzipFile(fileobj=fileobj, mode='rb')
+    return io.BufferedReader(stream, buffer_size=GZIP_BUFFER_SIZE)
+
+_PIPELINE_END = object()
+
+def _feed_queue(items: Iterator, out: queue.Queue, stop: threading.Event) -> None:
+    """Push items into a bounded queue, then _PIPELINE_END or the exception that ended them"""
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    try:
+        for item in items:
+            if not put(item):
+                return
+    except BaseException as e:
+        put(e)
+    else:
+        put(_PIPELINE_END)
+
+def run_stage(items: Iterator, stop: threading.Event) -> Iterator:
+    """Run an iterator on its own thread and yield its items through a bounded queue"""
+    out = queue.Queue(maxsize=PIPELINE_DEPTH)
+    threading.Thread(target=_feed_queue, args=(items, out, stop), daemon=True).start()
+    while True:
+        item = out.get()
+        if item is _PIPELINE_END:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+class ChunkReader(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks"""
+    
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._pending = memoryview(b'')
+    
+    def readable(self) -> bool:
+        return True
+    
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            chunk = next(self._chunks, b'')
+            if not chunk:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+def iter_line_blocks(stream) -> Iterator[bytes]:
+    """Read a binary stream in large blocks, each ending on a line boundary"""
+    tail = b''
+    while True:
+        chunk = stream.read(READ_BLOCK_SIZE)
+        if not chunk:
+            break
+        block = tail + chunk
+        cut = block.rfind(b'\n') + 1
+        tail = block[cut:]
+        if cut:
+            yield block[:cut]
+    if tail:
+        yield tail
+
+def iter_gram_counts(lines: List[bytes], n: int) -> Iterator[Tuple[bytes, int]]:
+    """Yield (gram, match_count) for every valid row in a block of shard lines"""
+    # Shards are ASCII TSV: ngram<TAB>year<TAB>match_count<TAB>volume_count
+    for line in lines:
+        gram, _, rest = line.partition(b'\t')
+        
+        # Every token must be non-empty and purely alphabetic; checked before the
+        # other fields are split out since most rows fail here
+        tokens = gram.split(b' ')
+        if len(tokens) != n or not all(tokens) or gram.translate(None, _GRAM_DELETE_BYTES):
+            continue
+        
+        fields = rest.split(b'\t', 2)
+        if len(fields) < 2:
+            continue
+        try:
+            match = int(fields[1])
+        except ValueError:
+            continue
+        
+        yield gram, match
+
+def parse_block_py(block: bytes, n: int, agg: Dict[bytes, int]) -> int:
+    """Add the grams of a block of complete lines into agg; returns the number of lines"""
+    lines = block.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    # Shards list every year of a gram on consecutive rows, so sum each run
+    # once; a run split across blocks is simply added to twice
+    for gram, rows in groupby(iter_gram_counts(lines, n), key=itemgetter(0)):
+        agg[gram] = agg.get(gram, 0) + sum(map(itemgetter(1), rows))
+    return len(lines)
+
+def make_parser_py(n: int) -> Callable[[bytes, Dict[bytes, int]], int]:
+    """Bind parse_block_py to one gram size, matching the compiled per-n parsers"""
+    def parse(block: bytes, agg: Dict[bytes, int]) -> int:
+        return parse_block_py(block, n, agg)
+    return parse
+
+try:
+    # Compiled versions of parse_block_py specialized per gram size, built on first
+    # import from ngram_parse.pyx
+    import pyximport
+    pyximport.install(language_level=3)
+    from ngram_parse import PARSERS
+except Exception as e:
+    logger.warning(f"Compiled parser unavailable, using pure Python parser: {e}")
+    PARSERS = {n: make_parser_py(n) for n in range(1, 6)}
+
+def shard_cache_path(url: str) -> Optional[str]:
+    """Local cache path for a shard keyed by URL and its current ETag, or None if not cacheable"""
+    if not SHARD_CACHE_DIR:
+        return None
+    head = SESSION.head(url, timeout=60)
+    head.raise_for_status()
+    etag = ''.join(ch for ch in head.headers.get('ETag', '') if ch.isalnum())
+    if not etag:
+        return None
+    url_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(SHARD_CACHE_DIR, f"{url_hash}_{etag}.gz")
+
+def tee_to_file(chunks: Iterator[bytes], path: str) -> Iterator[bytes]:
+    """Pass chunks through while saving them; the file only appears at path once complete"""
+    partial_path = f"{path}.{threading.get_ident()}.part"
+    completed = False
+    try:
+        with open(partial_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(partial_path, path)
+        completed = True
+    finally:
+        if not completed and os.path.exists(partial_path):
+            os.remove(partial_path)
+    remove_stale_cache_files(path)
+
+def remove_stale_cache_files(path: str) -> None:
+    """Delete cached copies of the same shard saved under an older ETag"""
+    url_hash = os.path.basename(path).split('_', 1)[0]
+    for stale_path in glob.glob(os.path.join(os.path.dirname(path), f"{url_hash}_*.gz")):
+        if stale_path != path:
+            logger.info(f"Removing stale cache file {stale_path}")
+            os.remove(stale_path)
 
 def build_shard_urls(n: int) -> List[str]:
     """Build URLs for n-gram shards"""
@@ -57,79 +279,152 @@ def build_shard_urls(n: int) -> List[str]:
     
     return urls
 
-def process_shard(url: str, n: int) -> Dict[str, int]:
-    """Process a single n-gram shard and return aggregated results"""
+def prune_grams(grams: Dict[bytes, int], top_n: int, keep: Optional[bytes] = None) -> Dict[bytes, int]:
+    """Keep only the top N grams over the frequency threshold, plus `keep` whose count may still grow"""
+    partial = grams.pop(keep, None) if keep is not None else None
+    pruned = dict(nlargest(top_n, ((gram, freq) for gram, freq in grams.items() if freq >= FREQUENCY_THRESHOLD),
+                           key=itemgetter(1)))
+    if partial is not None:
+        pruned[keep] = partial
+    return pruned
+
+def process_shard(url: str, n: int, top_n: int) -> Optional[List[Tuple[str, int]]]:
+    """Process a single n-gram shard and return its top N (gram, freq) pairs, or None on failure"""
     logger.info(f"Processing {url}")
-    agg = defaultdict(int)
+    agg = {}
     line_count = 0
     
     try:
-        response = requests.get(url, stream=True, timeout=300)
-        response.raise_for_status()
-        
-        # Handle gzip decompression
-        if url.endswith('.gz'):
-            stream = gzip.GzipFile(fileobj=response.raw)
-        else:
-            stream = response.raw
+        cache_path = shard_cache_path(url)
+        response = None
+        cached_file = None
+        gzip_stream = None
         
-        for line in stream:
-            line = line.decode('utf-8').strip()
-            if not line:
-                continue
-                
-            line_count += 1
-            if line_count % 50000 == 0:
-                logger.info(f"Processed {line_count} lines from {url}")
+        # Download, decompression and parsing run on separate threads linked by bounded
+        # queues, so the next chunks arrive and inflate while this thread parses a block
+        stop = threading.Event()
+        try:
+            if cache_path and os.path.exists(cache_path):
+                # A local file is seekable, which also lets rapidgzip decode it in parallel
+                logger.info(f"Reading {url} from cache {cache_path}")
+                cached_file = open(cache_path, 'rb')
+                stream = cached_file
+            else:
+                response = SESSION.get(url, stream=True, timeout=300)
+                response.raise_for_status()
+                chunks = response.raw.stream(RAW_CHUNK_SIZE, decode_content=False)
+                if cache_path:
+                    chunks = tee_to_file(chunks, cache_path)
+                stream = ChunkReader(run_stage(chunks, stop))
             
-            # Parse TSV: ngram<TAB>year<TAB>match_count<TAB>volume_count
-            parts = line.split('\t')
-            if len(parts) >= 3:
-                gram = parts[0]
-                try:
-                    match = int(parts[2])
-                except ValueError:
-                    continue
-                
-                tokens = gram.split(' ')
-                if len(tokens) != n or not is_clean_gram(tokens):
-                    continue
+            # Handle gzip decompression; the decoder is handed the raw gzip bytes
+            if url.endswith('.gz'):
+                stream = gzip_stream = open_gzip_stream(stream)
+            
+            parse = PARSERS[n]
+            next_log = LOG_EVERY_LINES
+            for block in run_stage(iter_line_blocks(stream), stop):
+                line_count += parse(block, agg)
                 
-                agg[gram] += match
+                # Each gram lives in exactly one shard and its rows are consecutive, so every
+                # gram except the last one parsed is final and the shard top N is the global
+                # top N for that prefix. Pruning bounds memory to ~2x top N per shard.
+                if len(agg) >= 2 * top_n:
+                    agg = prune_grams(agg, top_n, keep=next(reversed(agg)))
+                if line_count >= next_log:
+                    logger.info(f"Processed {line_count} lines from {url}")
+                    next_log = line_count + LOG_EVERY_LINES
+        except Exception:
+            # A corrupt cached copy would fail the same way on every attempt, so drop it and
+            # let the next attempt download the shard again. This also covers a download that
+            # ended early, which is only detected by the decoder after it has been cached.
+            if cache_path and os.path.exists(cache_path):
+                logger.warning(f"Removing unreadable cache file {cache_path}")
+                os.remove(cache_path)
+            raise
+        finally:
+            # Unblocks the download and decode threads if parsing stopped early
+            stop.set()
+            if gzip_stream is not None:
+                # Also joins rapidgzip's decoder threads
+                gzip_stream.close()
+            if response is not None:
+                response.close()
+            if cached_file is not None:
+                cached_file.close()
         
-        logger.info(f"Completed {url}: {line_count} lines, {len(agg)} unique grams")
-        return dict(agg)
+        top_grams = filter_and_rank(agg, n, top_n)
+        logger.info(f"Completed {url}: {line_count} lines, {len(top_grams)} grams kept")
+        return top_grams
         
+    except RETRYABLE_ERRORS:
+        # Let network failures propagate so the caller can retry the shard
+        raise
     except Exception as e:
         logger.error(f"Error processing {url}: {e}")
-        return {}
+        return None
 
-def filter_and_rank(grams: Dict[str, int], n: int, top_n: int) -> List[Dict[str, int]]:
-    """Filter and rank grams, returning top N results"""
-    # Filter by frequency threshold
-    filtered = {gram: freq for gram, freq in grams.items() if freq >= FREQUENCY_THRESHOLD}
-    
-    # Sort by frequency (descending) and take top N
-    sorted_grams = sorted(filtered.items(), key=lambda x: x[1], reverse=True)
-    top_grams = [{"gram": gram, "freq": freq} for gram, freq in sorted_grams[:top_n]]
-    
-    return top_grams
+def process_shard_with_retry(url: str, n: int, top_n: int) -> Optional[List[Tuple[str, int]]]:
+    """Process a shard, retrying on network errors. Returns None if the shard could not be processed"""
+    for attempt in range(1, SHARD_RETRIES + 1):
+        try:
+            return process_shard(url, n, top_n)
+        except RETRYABLE_ERRORS as e:
+            logger.warning(f"Attempt {attempt}/{SHARD_RETRIES} failed for {url}: {e}")
+            if attempt < SHARD_RETRIES:
+                time.sleep(2 ** attempt)
+    logger.error(f"Giving up on {url} after {SHARD_RETRIES} attempts")
+    return None
+
+def filter_and_rank(grams: Dict[bytes, int], n: int, top_n: int) -> List[Tuple[str, int]]:
+    """Filter and rank grams, returning top N (gram, freq) pairs"""
+    # Keep grams over the frequency threshold and take the top N by frequency (descending)
+    top = nlargest(top_n, ((gram, freq) for gram, freq in grams.items() if freq >= FREQUENCY_THRESHOLD),
+                   key=itemgetter(1))
+    return [(gram.decode('ascii'), freq) for gram, freq in top]
 
-def upload_to_storage(bucket_name: str, file_path: str, data: any) -> None:
-    """Upload data to Firebase Storage"""
+_storage_client: Optional[storage.Client] = None
+_storage_client_lock = threading.Lock()
+
+def get_storage_client() -> storage.Client:
+    """Return a Storage client shared by every upload in the process"""
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+    return _storage_client
+
+def upload_to_storage(bucket_name: str, file_path: str, data: any) -> bool:
+    """Upload data to Firebase Storage, returning whether the upload succeeded"""
     try:
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
+        bucket = get_storage_client().bucket(bucket_name)
         blob = bucket.blob(file_path)
+        # No chunk size means a single multipart request rather than a resumable session
+        blob.chunk_size = None
         
         if isinstance(data, (dict, list)):
-            blob.upload_from_string(json.dumps(data), content_type='application/json')
+            # Stored gzip-encoded; GCS and its clients decompress transparently on download
+            # Kept as JSON because the aggregation endpoint reads these files with JSON.parse
+            if orjson is not None:
+                body = orjson.dumps(data)
+            else:
+                body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+            payload = gzip.compress(body, compresslevel=UPLOAD_GZIP_LEVEL)
+            blob.content_encoding = 'gzip'
+            content_type = 'application/json'
         else:
-            blob.upload_from_string(data)
+            payload = data.encode('utf-8') if isinstance(data, str) else data
+            content_type = 'text/plain' if isinstance(data, str) else None
+        
+        # Shard outputs are rewritten with identical content on retry, so retrying is safe
+        blob.upload_from_file(io.BytesIO(payload), size=len(payload), content_type=content_type,
+                              retry=DEFAULT_RETRY)
             
         logger.info(f"Uploaded {file_path} to storage")
+        return True
     except Exception as e:
         logger.error(f"Error uploading {file_path}: {e}")
+        return False
 
 def update_firestore_checkpoint(ngram_type: str, shard_id: str, url: str) -> None:
     """Update Firestore checkpoint"""
@@ -145,16 +440,55 @@ def update_firestore_checkpoint(ngram_type: str, shard_id: str, url: str) -> Non
     except Exception as e:
         logger.error(f"Error updating checkpoint: {e}")
 
-def is_shard_done(ngram_type: str, shard_id: str, db_client: Optional[firestore.Client]) -> bool:
-    """Check if shard is already processed using provided Firestore client (supports non-default DB)."""
+def fetch_done_shards(ngram_type: str, db_client: Optional[firestore.Client]) -> Set[str]:
+    """Fetch checkpoint IDs of all finished shards of an n-gram type in one query (supports non-default DB)."""
+    prefix = f"{ngram_type}_"
     try:
         client = db_client or firestore.Client()
-        doc_ref = client.collection('ngram_shards').document(f"{ngram_type}_{shard_id}")
-        doc = doc_ref.get()
-        return doc.exists and doc.get('status') == 'done'
+        docs = client.collection('ngram_shards').where(filter=FieldFilter('status', '==', 'done')).stream()
+        return {doc.id for doc in docs if doc.id.startswith(prefix)}
     except Exception as e:
-        logger.error(f"Error checking checkpoint: {e}")
-        return False
+        logger.error(f"Error fetching checkpoints: {e}")
+        return set()
+
+def checkpoint_shard(ngram_type: str, shard_id: str, url: str, db_client: Optional[firestore.Client],
+                     bulk: Optional[BulkWriter]) -> None:
+    """Mark a shard as done, queuing the write on the BulkWriter when Firestore is available"""
+    try:
+        if bulk:
+            # Use the initialized client rather than implicit default
+            doc_ref = db_client.collection('ngram_shards').document(f"{ngram_type}_{shard_id}")
+            bulk.set(doc_ref, {
+                'status': 'done',
+                'url': url,
+                'updatedAt': firestore.SERVER_TIMESTAMP
+            })
+        else:
+            update_firestore_checkpoint(ngram_type, shard_id, url)
+    except Exception as e:
+        logger.error(f"Error updating checkpoint with explicit client: {e}")
+
+def log_checkpoint_error(error: BulkWriteFailure, bulk: BulkWriter) -> bool:
+    """BulkWriter error callback: retry the write, and log it once the attempts run out"""
+    if error.attempts < CHECKPOINT_WRITE_ATTEMPTS:
+        return True
+    # The shard stays unchecked and is redone on the next run
+    logger.error(f"Error writing checkpoint {error.operation.reference.id} after "
+                 f"{error.attempts} attempts: {error.message}")
+    return False
+
+def checkpoint_uploaded(uploads: Dict[Future, Tuple[str, str]], ngram_type: str,
+                        db_client: Optional[firestore.Client], bulk: Optional[BulkWriter]) -> int:
+    """Checkpoint shards whose uploads have finished and return how many succeeded"""
+    checkpointed = 0
+    for upload in [upload for upload in uploads if upload.done()]:
+        shard_id, url = uploads.pop(upload)
+        if not upload.result():
+            # Leave the checkpoint unset so the shard is retried on the next run
+            continue
+        checkpoint_shard(ngram_type, shard_id, url, db_client, bulk)
+        checkpointed += 1
+    return checkpointed
 
 def main():
     """Main processing function"""
@@ -175,55 +509,75 @@ def main():
         logger.error(f"Failed to initialize Firestore client: {e}")
         db_client = None
 
+    upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    
     # Process each n-gram type
     for n in range(1, 6):
         ngram_type = f"{n}gram"
+        top_n = TOP_COUNTS[ngram_type]
         logger.info(f"Processing {ngram_type}")
         
         urls = build_shard_urls(n)
         processed_count = 0
         skipped_count = 0
         
+        done_shards = fetch_done_shards(ngram_type, db_client)
+        pending_urls = {}
         for url in urls:
             shard_id = url.split('/')[-1].replace('.gz', '')
             
             # Check if already processed
-            if is_shard_done(ngram_type, shard_id, db_client):
+            if f"{ngram_type}_{shard_id}" in done_shards:
                 logger.info(f"Skipping {ngram_type}/{shard_id} - already processed")
                 skipped_count += 1
                 continue
-            
-            # Process shard
-            shard_results = process_shard(url, n)
-            
-            # Save filtered results for this shard
-            filtered_shard = {gram: freq for gram, freq in shard_results.items() 
-                            if freq >= FREQUENCY_THRESHOLD}
-            shard_file = f"{out_prefix}/{ngram_type}_{shard_id}_filtered.json"
-            upload_to_storage(bucket_name, shard_file, filtered_shard)
-            
-            # Update checkpoint (if Firestore available)
+            pending_urls[url] = shard_id
+        
+        # Checkpoints are queued on a BulkWriter, which commits them in batches
+        # instead of one RPC per shard; it is flushed at the end of each n-gram type
+        bulk = db_client.bulk_writer() if db_client else None
+        if bulk:
+            # BulkWriter drops a write once it stops retrying, without raising from close()
+            bulk.on_write_error(log_checkpoint_error)
+        
+        # Download and parse shards in parallel; each finished shard is uploaded in the
+        # background and checkpointed once its upload has succeeded
+        uploads = {}
+        with ThreadPoolExecutor(max_workers=SHARD_WORKERS) as executor:
+            futures = {executor.submit(process_shard_with_retry, url, n, top_n): url for url in pending_urls}
+            for future in as_completed(futures):
+                # Drop the future once consumed so each shard's grams are freed as soon as
+                # they are uploaded rather than held until every shard of the type is done
+                url = futures.pop(future)
+                shard_id = pending_urls[url]
+                shard_results = future.result()
+                if shard_results is None:
+                    # Leave the checkpoint unset so the shard is retried on the next run
+                    continue
+                
+                # Save filtered results for this shard
+                # Shard files keep the {gram: freq} object format the aggregation endpoint reads
+                filtered_shard = dict(shard_results)
+                shard_file = f"{out_prefix}/{ngram_type}_{shard_id}_filtered.json"
+                uploads[upload_pool.submit(upload_to_storage, bucket_name, shard_file, filtered_shard)] = (shard_id, url)
+                
+                processed_count += checkpoint_uploaded(uploads, ngram_type, db_client, bulk)
+        
+        # Wait for the remaining uploads of this n-gram type before flushing checkpoints
+        wait(uploads)
+        processed_count += checkpoint_uploaded(uploads, ngram_type, db_client, bulk)
+        
+        if bulk:
             try:
-                if db_client:
-                    # Use the initialized client rather than implicit default
-                    doc_ref = db_client.collection('ngram_shards').document(f"{ngram_type}_{shard_id}")
-                    doc_ref.set({
-                        'status': 'done',
-                        'url': url,
-                        'updatedAt': firestore.SERVER_TIMESTAMP
-                    })
-                else:
-                    update_firestore_checkpoint(ngram_type, shard_id, url)
+                bulk.close()
             except Exception as e:
-                logger.error(f"Error updating checkpoint with explicit client: {e}")
-            processed_count += 1
-            
-            # Small delay to avoid overwhelming the system
-            time.sleep(1)
+                logger.error(f"Error flushing checkpoints for {ngram_type}: {e}")
         
         logger.info(f"Completed {ngram_type}: processed {processed_count}, skipped {skipped_count}")
         logger.info(f"Note: Top files will be generated separately via Cloud Run aggregation endpoint")
     
+    upload_pool.shutdown()
+    
     # Update system job status
     try:
         db = firestore.Client()